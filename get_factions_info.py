@@ -1,10 +1,22 @@
-import xml.etree.ElementTree as ET
 import csv
 import os
 import logging
+import pickle
 import argparse
 import sys
-import re
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from x4_common import (
+    ET,
+    MAX_PARSE_WORKERS,
+    PAREN_RE,
+    PLACEHOLDER_RE,
+    iter_elements,
+    iter_extension_dirs,
+    load_localization,
+    open_output_csv
+)
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
@@ -15,95 +27,124 @@ DEFAULT_EXCLUDE_PATTERNS = [r'^timelines_map_', r'^demo_']
 # Define default output folder
 DEFAULT_OUTPUT_FOLDER = 'output'
 
-def parse_name_reference(name_ref):
-    """Parse name reference like {20201,401} into (page_id, t_id)"""
-    if not name_ref:
-        return None
-    try:
-        name_ref = name_ref.strip('{}')
-        page_id, t_id = map(int, name_ref.split(','))
-        return f"{page_id}_{t_id}"
-    except:
-        return None
-
-def load_localization(file_path):
-    """Load localization mappings from l044 file using page/t structure"""
-    name_map = {}
+# Localization cache file stored in the output folder, and the version of its content
+LOCALIZATION_CACHE_FILE = '.name_map.pkl'
+LOCALIZATION_CACHE_VERSION = 3
+
+def load_localization_cached(file_path, cache_folder):
+    """
+    Load localization mappings, reusing the copy pickled into cache_folder by a previous
+    run as long as the localization file has not changed (same path, mtime and size).
+    """
+    cache_path = os.path.join(cache_folder, LOCALIZATION_CACHE_FILE)
+    stat = os.stat(file_path)
+    key = (LOCALIZATION_CACHE_VERSION, os.path.abspath(file_path), stat.st_mtime, stat.st_size)
+
     try:
-        tree = ET.parse(file_path)
-        root = tree.getroot()
-
-        # Find all page elements
-        for page in root.findall('.//page'):
-            page_id = page.get('id')
-            if not page_id:
-                continue
-
-            # Process t elements within each page
-            for t in page.findall('.//t'):
-                t_id = t.get('id')
-                if t_id:
-                    # Create combined key: pageID_tID
-                    key = f"{page_id}_{t_id}"
-                    name_map[key] = t.text if t.text else ''
-
-        logger.info(f"Loaded {len(name_map)} localization entries from {file_path}")
-        return name_map
+        with open(cache_path, 'rb') as f:
+            cached_key, name_map = pickle.load(f)
+        if cached_key == key:
+            logger.info(f"Loaded {len(name_map)} localization entries from cache {cache_path}")
+            return name_map
+    except FileNotFoundError:
+        pass
     except Exception as e:
-        logger.error(f"Error loading localization: {e}")
-        return {}
+        logger.warning(f"Ignoring unreadable localization cache '{cache_path}': {e}")
+
+    name_map = load_localization(file_path)
+    if name_map:
+        try:
+            with open(cache_path, 'wb') as f:
+                pickle.dump((key, name_map), f, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            logger.warning(f"Failed to write localization cache '{cache_path}': {e}")
+    return name_map
 
-def resolve_placeholders(text, name_map, processed_keys=None, max_depth=10):
+def build_resolver(name_map):
     """
-    Recursively resolve placeholders in the format {pageID,tID} within the text.
+    Build a resolver for placeholders in the format {pageID,tID} within the text.
     Removes any text within parentheses after resolution.
 
-    Enhanced to accurately detect circular references by tracking processed keys per recursion path.
+    Every localization key is resolved once, iteratively, and kept in a cache shared by
+    all calls of the returned function. Keys on the current resolution path are tracked
+    in a set to detect circular references. Texts reached through a circular reference
+    depend on where the resolution started, so they are only kept for the current one.
     """
-    if processed_keys is None:
-        processed_keys = []
-
-    # Regex to find placeholders like {20201,401}
-    pattern = re.compile(r'\{(\d+),(\d+)\}')
-
-    def replacer(match):
-        page_id, t_id = match.groups()
-        key = f"{page_id}_{t_id}"
-
-        # Prevent infinite recursion by checking if key is already in the current path
-        if key in processed_keys:
-            logger.warning(f"Circular reference detected for key: {key}")
+    cache = {}
+
+    def substitute(text, partial, in_progress):
+        cyclic = False
+
+        def replacer(match):
+            nonlocal cyclic
+            key = (int(match.group(1)), int(match.group(2)))
+            if key in cache:
+                return cache[key]
+            cyclic = True
+            if key in partial:
+                return partial[key]
+            if key in in_progress:
+                logger.warning(f"Circular reference detected for key: {key}")
             return match.group(0)  # Return as is
 
-        processed_keys.append(key)  # Add key to the current path
-
-        replacement = name_map.get(key, 'Unknown')
-        if replacement == 'Unknown':
-            logger.warning(f"Missing localization for key: {key}")
-            processed_keys.pop()  # Remove key from the current path before returning
-            return 'Unknown'
-
-        # Recursively resolve if replacement contains more placeholders
-        replacement = resolve_placeholders(replacement, name_map, processed_keys, max_depth - 1)
-
-        processed_keys.pop()  # Remove key from the current path after resolving
-        return replacement
-
-    # Iterate up to max_depth to resolve nested placeholders
-    current_text = text
-    for depth in range(max_depth):
-        new_text = pattern.sub(replacer, current_text)
-        if new_text == current_text:
-            break
-        logger.debug(f"Depth {depth + 1}: {current_text} -> {new_text}")
-        current_text = new_text
-    else:
-        logger.warning(f"Max recursion depth reached while resolving: {text}")
-
-    # Remove any text within parentheses
-    resolved_text = re.sub(r'\s*\([^)]*\)', '', current_text).strip()
-
-    return resolved_text
+        return PAREN_RE.sub('', PLACEHOLDER_RE.sub(replacer, text)).strip(), cyclic
+
+    def resolve_key(key, partial):
+        stack = [key]
+        in_progress = {key}
+        while stack:
+            current = stack[-1]
+            # The localization map holds the raw texts, None for empty ones
+            raw = (name_map[current] or '') if current in name_map else None
+            if raw is None:
+                logger.warning(f"Missing localization for key: {current}")
+                cache[current] = 'Unknown'
+            elif '{' not in raw:
+                # Plain texts only need their parenthetical notes stripped, once per key
+                cache[current] = PAREN_RE.sub('', raw).strip()
+            else:
+                # Resolve the first unresolved nested key before this one
+                pending = None
+                for match in PLACEHOLDER_RE.finditer(raw):
+                    nested_key = (int(match.group(1)), int(match.group(2)))
+                    if nested_key not in cache and nested_key not in partial and nested_key not in in_progress:
+                        pending = nested_key
+                        break
+                if pending is not None:
+                    stack.append(pending)
+                    in_progress.add(pending)
+                    continue
+                text, cyclic = substitute(raw, partial, in_progress)
+                if cyclic:
+                    partial[current] = text
+                else:
+                    cache[current] = text
+            stack.pop()
+            in_progress.discard(current)
+        return cache[key] if key in cache else partial[key]
+
+    def resolve(text):
+        # Empty and plain literal attributes need no placeholder handling at all
+        if not text:
+            return ''
+        if '{' not in text:
+            return PAREN_RE.sub('', text).strip()
+
+        # Most references are a single placeholder, which is exactly one cached key
+        match = PLACEHOLDER_RE.fullmatch(text)
+        if match:
+            key = (int(match.group(1)), int(match.group(2)))
+            return cache[key] if key in cache else resolve_key(key, {})
+
+        # Keys reached through a circular reference are resolved from each of them alone
+        values = {}
+        for match in PLACEHOLDER_RE.finditer(text):
+            key = (int(match.group(1)), int(match.group(2)))
+            if key not in cache and key not in values:
+                values[key] = resolve_key(key, {})
+        return substitute(text, values, set())[0]
+
+    return resolve
 
 def find_factions_files(base_folder):
     """Find all factions.xml files with their sources"""
@@ -118,11 +159,11 @@ def find_factions_files(base_folder):
     # Search extensions for factions.xml
     extensions_path = os.path.join(base_folder, 'extensions')
     if os.path.exists(extensions_path):
-        for ext_dir in os.listdir(extensions_path):
-            ext_factions = os.path.join(extensions_path, ext_dir, 'libraries', 'factions.xml')
+        for ext_name, ext_path in iter_extension_dirs(extensions_path):
+            ext_factions = os.path.join(ext_path, 'libraries', 'factions.xml')
             if os.path.exists(ext_factions):
-                factions_files.append((ext_dir, ext_factions))
-                logger.info(f"Found factions.xml in extension '{ext_dir}': {ext_factions}")
+                factions_files.append((ext_name, ext_factions))
+                logger.info(f"Found factions.xml in extension '{ext_name}': {ext_factions}")
 
     if not factions_files:
         logger.warning("No factions.xml files found")
@@ -131,61 +172,73 @@ def find_factions_files(base_folder):
 
     return factions_files
 
+def _parse_factions_file(resolve, factions_file_entry):
+    """Parse one (source, factions_file_path) entry into a list of rows with resolved names."""
+    source, factions_file = factions_file_entry
+    rows = []
+    try:
+        for faction in iter_elements(factions_file, 'faction'):
+            faction_id = faction.get('id', '').strip()
+            if not faction_id:
+                logger.warning(f"Faction without ID found in {factions_file}. Skipping entry.")
+                continue  # Skip factions without valid ID
+
+            # Extract attributes
+            name_ref = faction.get('name', '').strip()
+            shortname_ref = faction.get('shortname', '').strip()
+            prefixname_ref = faction.get('prefixname', '').strip()
+            spacename_ref = faction.get('spacename', '').strip()
+            homespacename_ref = faction.get('homespacename', '').strip()
+            primaryrace = faction.get('primaryrace', '').strip()
+
+            # Resolve placeholders
+            name = resolve(name_ref)
+            shortname = resolve(shortname_ref)
+            prefixname = resolve(prefixname_ref)
+            spacename = resolve(spacename_ref)
+            homespacename = resolve(homespacename_ref)
+
+            # Append the row
+            rows.append({
+                'id': faction_id,
+                'name': name,
+                'shortname': shortname,
+                'prefixname': prefixname,
+                'spacename': spacename,
+                'homespacename': homespacename,
+                'primaryrace': primaryrace,
+                'source': source
+            })
+
+    except ET.ParseError as e:
+        logger.error(f"XML parsing error in {factions_file}: {e}")
+        return []  # Drop the rows streamed before the error, the file is broken
+    except Exception as e:
+        logger.error(f"Error processing {factions_file}: {e}")
+
+    return rows
+
 def process_factions(factions_files, name_map, output_folder):
     """Process all factions.xml files and write to factions_output.csv with resolved names."""
     all_rows = []
+    resolve = build_resolver(name_map)
 
-  # Ensure the output folder exists
-    if not os.path.exists(output_folder):
-        try:
-            os.makedirs(output_folder)
-            logger.info(f"Created output directory at: {output_folder}")
-        except Exception as e:
-            logger.error(f"Failed to create output directory '{output_folder}': {e}")
-            return
+    # Factions, including the ones from extensions, keep referring to the same names,
+    # so resolve each raw reference once across all files
+    resolve_cache = {}
 
-    for source, factions_file in factions_files:
-        try:
-            tree = ET.parse(factions_file)
-            root = tree.getroot()
-
-            for faction in root.findall('.//faction'):
-                faction_id = faction.get('id', '').strip()
-                if not faction_id:
-                    logger.warning(f"Faction without ID found in {factions_file}. Skipping entry.")
-                    continue  # Skip factions without valid ID
-
-                # Extract attributes
-                name_ref = faction.get('name', '').strip()
-                shortname_ref = faction.get('shortname', '').strip()
-                prefixname_ref = faction.get('prefixname', '').strip()
-                spacename_ref = faction.get('spacename', '').strip()
-                homespacename_ref = faction.get('homespacename', '').strip()
-                primaryrace = faction.get('primaryrace', '').strip()
-
-                # Resolve placeholders
-                name = resolve_placeholders(name_ref, name_map)
-                shortname = resolve_placeholders(shortname_ref, name_map)
-                prefixname = resolve_placeholders(prefixname_ref, name_map)
-                spacename = resolve_placeholders(spacename_ref, name_map)
-                homespacename = resolve_placeholders(homespacename_ref, name_map)
-
-                # Append the row
-                all_rows.append({
-                    'id': faction_id,
-                    'name': name,
-                    'shortname': shortname,
-                    'prefixname': prefixname,
-                    'spacename': spacename,
-                    'homespacename': homespacename,
-                    'primaryrace': primaryrace,
-                    'source': source
-                })
-
-        except ET.ParseError as e:
-            logger.error(f"XML parsing error in {factions_file}: {e}")
-        except Exception as e:
-            logger.error(f"Error processing {factions_file}: {e}")
+    def cached_resolve(ref):
+        value = resolve_cache.get(ref)
+        if value is None:
+            value = resolve(ref)
+            resolve_cache[ref] = value
+        return value
+
+    # Parse the files concurrently, keeping the rows in the original file order
+    max_workers = max(1, min(MAX_PARSE_WORKERS, len(factions_files)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for rows in executor.map(partial(_parse_factions_file, cached_resolve), factions_files):
+            all_rows.extend(rows)
 
     if not all_rows:
         logger.warning("No faction data extracted from factions.xml files")
@@ -197,12 +250,11 @@ def process_factions(factions_files, name_map, output_folder):
     output_path = os.path.join(output_folder, 'factions_output.csv')
 
     try:
-        with open(output_path, 'w', newline='', encoding='utf-8') as csvfile:
+        with open_output_csv(output_path) as csvfile:
             writer = csv.DictWriter(csvfile, fieldnames=csv_columns)
             writer.writeheader()
 
-            for row in all_rows:
-                writer.writerow(row)
+            writer.writerows(all_rows)
 
         logger.info("factions_output.csv has been created successfully")
     except IOError as e:
@@ -251,7 +303,12 @@ def main():
         if not os.path.exists(loc_path):
             raise FileNotFoundError("Localization file '0001-l044.xml' not found in 't' directory")
 
-        name_map = load_localization(loc_path)
+        # Ensure the output folder exists, the localization cache is stored there too
+        if not os.path.exists(output_folder):
+            os.makedirs(output_folder)
+            logger.info(f"Created output directory at: {output_folder}")
+
+        name_map = load_localization_cached(loc_path, output_folder)
 
         # Find all factions.xml files
         factions_files = find_factions_files(base_folder)
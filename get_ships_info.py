@@ -1,10 +1,20 @@
-import xml.etree.ElementTree as ET
 import csv
 import os
 import logging
 import argparse
 import sys
 import re
+from concurrent.futures import ThreadPoolExecutor
+
+from x4_common import (
+    ET,
+    CSV_LINE_TERMINATOR,
+    CSV_SPECIAL_CHARS,
+    MAX_PARSE_WORKERS,
+    iter_elements,
+    iter_extension_dirs,
+    open_output_csv
+)
 
 # Setup logging
 logging.basicConfig(level=logging.DEBUG)
@@ -13,6 +23,12 @@ logger = logging.getLogger(__name__)
 # Define default output folder
 DEFAULT_OUTPUT_FOLDER = 'output'
 
+# Number of CSV lines joined into a single write
+WRITE_BATCH_ROWS = 4096
+
+# Regex to split faction and tag lists like "[argon, paranid]" into names
+_WORD_RE = re.compile(r'\w+')
+
 def find_ships_files(base_folder):
     """
     Find all ships.xml files within the base_folder and its subdirectories.
@@ -32,12 +48,12 @@ def find_ships_files(base_folder):
     # Search extensions for ships.xml
     extensions_path = os.path.join(base_folder, 'extensions')
     if os.path.exists(extensions_path):
-        for ext_dir in os.listdir(extensions_path):
-            ext_map_dir = os.path.join(extensions_path, ext_dir, 'libraries')
+        for ext_name, ext_path in iter_extension_dirs(extensions_path):
+            ext_map_dir = os.path.join(ext_path, 'libraries')
             ext_ships = os.path.join(ext_map_dir, 'ships.xml')
             if os.path.exists(ext_ships):
-                ships_files.append((ext_dir, ext_ships))
-                logger.info(f"Found ships.xml in extension '{ext_dir}': {ext_ships}")
+                ships_files.append((ext_name, ext_ships))
+                logger.info(f"Found ships.xml in extension '{ext_name}': {ext_ships}")
 
     if not ships_files:
         logger.warning("No ships.xml files found")
@@ -46,66 +62,160 @@ def find_ships_files(base_folder):
 
     return ships_files
 
-def process_ships(ships_files, output_folder):
+def _scan(ships_files, want_rows, failed_files=None):
     """
-    Process all ships.xml files and write to ships_output.csv with id, group, size, source,
-    and dynamic columns for factions and tags.
+    Stream ship entries from all ships.xml files, freeing each element once handled.
 
     Args:
         ships_files (list): List of tuples containing (source, ships_file_path)
-    """
-    ships_data = []
-    factions_set = set()
-    tags_set = set()
+        want_rows (bool): Yield full rows instead of only factions and tags
+        failed_files (list): Optional list collecting paths of files that failed to parse
 
+    Yields:
+        (factions, tags), or (id, group, size, source, factions, tags) if want_rows is set
+    """
     for source, ships_file in ships_files:
         try:
-            tree = ET.parse(ships_file)
-            root = tree.getroot()
-
-            for ship in root.findall('ship'):
+            for ship in iter_elements(ships_file, 'ship', top_level=True):
                 ship_id = ship.get('id', '').strip()
                 if not ship_id:
-                    logger.warning(f"Ship without ID found in {ships_file}. Skipping entry.")
-                    # Log the structure of the ship
-                    ship_str = ET.tostring(ship, encoding='unicode')
-                    logger.debug(f"Ship details: {ship_str}")
+                    # Report it only once, on the first pass
+                    if not want_rows:
+                        logger.warning(f"Ship without ID found in {ships_file}. Skipping entry.")
+                        # Log the structure of the ship
+                        ship_str = ET.tostring(ship, encoding='unicode')
+                        logger.debug(f"Ship details: {ship_str}")
                     continue  # Skip ships without valid ID
 
-                group = ship.get('group', '').strip()
-
-                # Extract size from category
+                # Extract size, faction and tags from category
                 category = ship.find('category')
-                size = category.get('size', '').strip() if category is not None else ''
-
-                # Extract faction and tags
-                faction = category.get('faction', '').strip() if category is not None else ''
-                tags = category.get('tags', '').strip() if category is not None else ''
-
-                # Process factions
-                factions = re.findall(r'\w+', faction)
-                for f in factions:
-                    factions_set.add(f)
-
-                # Process tags
-                tags = re.findall(r'\w+', tags)
-                for tag in tags:
-                    tags_set.add(tag)
-
-                ships_data.append({
-                    'id': ship_id,
-                    'group': group,
-                    'size': size,
-                    'source': source,
-                    'factions': factions,
-                    'tags': tags
-                })
+                if category is not None:
+                    size = category.get('size', '').strip()
+                    factions = _WORD_RE.findall(category.get('faction', '').strip())
+                    tags = _WORD_RE.findall(category.get('tags', '').strip())
+                else:
+                    size = ''
+                    factions = []
+                    tags = []
+
+                if want_rows:
+                    group = ship.get('group', '').strip()
+                    yield ship_id, group, size, source, factions, tags
+                else:
+                    yield factions, tags
         except ET.ParseError as e:
             logger.error(f"XML parsing error in {ships_file}: {e}")
+            if failed_files is not None:
+                failed_files.append(ships_file)
         except Exception as e:
             logger.error(f"Error processing {ships_file}: {e}")
+            if failed_files is not None:
+                failed_files.append(ships_file)
+
+def _collect_columns(ships_file_entry):
+    """
+    Collect the faction and tag names used in one ships.xml file.
 
-    if not ships_data:
+    Args:
+        ships_file_entry (tuple): (source, ships_file_path)
+
+    Returns:
+        tuple: (ships_count, factions_set, tags_set), or None if the file failed to parse
+    """
+    ships_count = 0
+    factions_set = set()
+    tags_set = set()
+    failed_files = []
+
+    for factions, tags in _scan([ships_file_entry], want_rows=False, failed_files=failed_files):
+        ships_count += 1
+        factions_set.update(factions)
+        tags_set.update(tags)
+
+    if failed_files:
+        return None
+    return ships_count, factions_set, tags_set
+
+def _ship_rows(ships_files, col_index, n_flags):
+    """
+    Stream the CSV rows for all ships, with a TRUE/FALSE cell per faction and tag column.
+
+    Args:
+        ships_files (list): List of tuples containing (source, ships_file_path)
+        col_index (dict): Enclosed faction/tag name to its column position after the fixed columns
+        n_flags (int): Number of faction and tag columns
+    """
+    for ship_id, group, size, source, factions, tags in _scan(ships_files, want_rows=True):
+        # All faction and tag columns start as 'FALSE'
+        row = [ship_id, group, size, source] + ['FALSE'] * n_flags
+
+        # Set 'TRUE' for factions present in the ship
+        for faction in factions:
+            row[4 + col_index[f"({faction})"]] = 'TRUE'
+
+        # Set 'TRUE' for tags present in the ship
+        for tag in tags:
+            row[4 + col_index[f"[{tag}]"]] = 'TRUE'
+
+        yield row
+
+def _write_rows(csvfile, rows):
+    """
+    Write ship rows as joined CSV lines in batches of WRITE_BATCH_ROWS.
+
+    Only the id, group, size and source values can contain characters that need
+    quoting; rows with such values are written through csv.writer instead.
+
+    Args:
+        csvfile: Text file opened for writing
+        rows (iterable): Lists of string values
+    """
+    writer = csv.writer(csvfile, lineterminator=CSV_LINE_TERMINATOR)
+    lines = []
+    for row in rows:
+        if any(char in value for value in row[:4] for char in CSV_SPECIAL_CHARS):
+            # Keep the order: flush pending lines before the csv module writes its row
+            csvfile.write(''.join(lines))
+            lines.clear()
+            writer.writerow(row)
+            continue
+
+        lines.append(','.join(row) + CSV_LINE_TERMINATOR)
+        if len(lines) >= WRITE_BATCH_ROWS:
+            csvfile.write(''.join(lines))
+            lines.clear()
+
+    csvfile.write(''.join(lines))
+
+def process_ships(ships_files, output_folder):
+    """
+    Process all ships.xml files and write to ships_output.csv with id, group, size, source,
+    and dynamic columns for factions and tags.
+
+    The files are streamed twice: the first pass collects the faction and tag columns
+    from all files concurrently, the second one writes the rows directly to the CSV file.
+
+    Args:
+        ships_files (list): List of tuples containing (source, ships_file_path)
+    """
+    ships_count = 0
+    factions_set = set()
+    tags_set = set()
+    parsed_files = []
+
+    # Collect the columns from all files concurrently
+    max_workers = max(1, min(MAX_PARSE_WORKERS, len(ships_files)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for ships_file_entry, columns in zip(ships_files, executor.map(_collect_columns, ships_files)):
+            if columns is None:
+                continue  # Skip files that failed to parse
+            file_ships_count, file_factions, file_tags = columns
+            ships_count += file_ships_count
+            factions_set |= file_factions
+            tags_set |= file_tags
+            parsed_files.append(ships_file_entry)
+
+    if not ships_count:
         logger.warning("No ship data extracted from ships.xml files")
         return
 
@@ -120,43 +230,17 @@ def process_ships(ships_files, output_folder):
     # Define CSV columns with enclosed names
     csv_columns = ['id', 'group', 'size', 'source'] + sorted_factions + sorted_tags
 
+    # Map every enclosed faction/tag column to its position after the fixed columns
+    col_index = {name: i for i, name in enumerate(sorted_factions + sorted_tags)}
+
     # Define output file path
     output_path = os.path.join(output_folder, 'ships_output.csv')
 
     try:
-        with open(output_path, 'w', newline='', encoding='utf-8') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=csv_columns)
-            writer.writeheader()
-
-            for ship in ships_data:
-                row = {
-                    'id': ship['id'],
-                    'group': ship['group'],
-                    'size': ship['size'],
-                    'source': ship['source']
-                }
-
-                # Initialize all enclosed faction columns to 'FALSE'
-                for enclosed_faction in sorted_factions:
-                    row[enclosed_faction] = 'FALSE'
-
-                # Initialize all enclosed tag columns to 'FALSE'
-                for enclosed_tag in sorted_tags:
-                    row[enclosed_tag] = 'FALSE'
-
-                # Set 'TRUE' for factions present in the ship
-                for faction in ship['factions']:
-                    enclosed_faction = enclosed_factions.get(faction)
-                    if enclosed_faction:
-                        row[enclosed_faction] = 'TRUE'
-
-                # Set 'TRUE' for tags present in the ship
-                for tag in ship['tags']:
-                    enclosed_tag = enclosed_tags.get(tag)
-                    if enclosed_tag:
-                        row[enclosed_tag] = 'TRUE'
-
-                writer.writerow(row)
+        with open_output_csv(output_path) as csvfile:
+            # Column names are plain words, so the header never needs quoting
+            csvfile.write(','.join(csv_columns) + CSV_LINE_TERMINATOR)
+            _write_rows(csvfile, _ship_rows(parsed_files, col_index, len(col_index)))
 
         logger.info("ships_output.csv has been created successfully")
     except IOError as e:
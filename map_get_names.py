@@ -1,10 +1,21 @@
-import xml.etree.ElementTree as ET
 import csv
 import os
 import logging
 import argparse
 import sys
 import re
+from operator import itemgetter
+
+from x4_common import (
+    ET,
+    PAREN_RE,
+    PLACEHOLDER_RE,
+    iter_elements,
+    iter_extension_dirs,
+    load_localization,
+    open_output_csv,
+    parse_name_reference
+)
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
@@ -16,43 +27,11 @@ DEFAULT_EXCLUDE_PATTERNS = [r'^timelines_map_', r'^demo_']
 # Define default output folder
 DEFAULT_OUTPUT_FOLDER = 'output'
 
-def parse_name_reference(name_ref):
-    """Parse name reference like {20201,401} into (page_id, t_id)"""
-    if not name_ref:
-        return None
-    try:
-        name_ref = name_ref.strip('{}')
-        page_id, t_id = map(int, name_ref.split(','))
-        return f"{page_id}_{t_id}"
-    except:
-        return None
+# Regex to find the first two numbers in macro names
+_TWO_NUMS = re.compile(r'(\d+)(?:\D+(\d+))?')
 
-def load_localization(file_path):
-    """Load localization mappings from l044 file using page/t structure"""
-    name_map = {}
-    try:
-        tree = ET.parse(file_path)
-        root = tree.getroot()
-
-        # Find all page elements
-        for page in root.findall('.//page'):
-            page_id = page.get('id')
-            if not page_id:
-                continue
-
-            # Process t elements within each page
-            for t in page.findall('.//t'):
-                t_id = t.get('id')
-                if t_id:
-                    # Create combined key: pageID_tID
-                    key = f"{page_id}_{t_id}"
-                    name_map[key] = t.text.strip() if t.text else ''
-
-        logger.info(f"Loaded {len(name_map)} localization entries from {file_path}")
-        return name_map
-    except Exception as e:
-        logger.error(f"Error loading localization: {e}")
-        return {}
+# Fully resolved localization texts, keyed by localization key
+_resolved_cache = {}
 
 def find_mapdefaults_files(base_folder):
     """Find all mapdefaults.xml files with their sources"""
@@ -66,10 +45,10 @@ def find_mapdefaults_files(base_folder):
     # Search extensions
     extensions_path = os.path.join(base_folder, 'extensions')
     if os.path.exists(extensions_path):
-        for ext_dir in os.listdir(extensions_path):
-            ext_mapdefaults = os.path.join(extensions_path, ext_dir, 'libraries', 'mapdefaults.xml')
+        for ext_name, ext_path in iter_extension_dirs(extensions_path):
+            ext_mapdefaults = os.path.join(ext_path, 'libraries', 'mapdefaults.xml')
             if os.path.exists(ext_mapdefaults):
-                mapdefaults_files.append((ext_dir, ext_mapdefaults))
+                mapdefaults_files.append((ext_name, ext_mapdefaults))
 
     if not mapdefaults_files:
         logger.warning("No mapdefaults.xml files found")
@@ -86,70 +65,125 @@ def extract_cluster_sector(macro):
     Returns:
         tuple: (cluster_id, sector_id, type)
     """
-    numbers = re.findall(r'\d+', macro)
-    if len(numbers) >= 2:
-        cluster_id = int(numbers[0])
-        sector_id = int(numbers[1])
-        return (cluster_id, sector_id, 'sector')
-    elif len(numbers) == 1:
-        cluster_id = int(numbers[0])
-        sector_id = 0
-        return (cluster_id, sector_id, 'cluster')
-    else:
+    numbers = _TWO_NUMS.search(macro)
+    if numbers is None:
         logger.warning(f"Could not extract cluster and sector IDs from macro: {macro}")
         return (0, 0, 'unknown')  # Default values if extraction fails
 
-def resolve_placeholders(text, name_map, processed_keys=None, max_depth=10):
+    cluster_id = int(numbers[1])
+    if numbers[2]:
+        sector_id = int(numbers[2])
+        return (cluster_id, sector_id, 'sector')
+    return (cluster_id, 0, 'cluster')
+
+def _resolve_key(key, name_map, stack):
     """
-    Recursively resolve placeholders in the format {pageID,tID} within the text.
-    Removes any text within parentheses after resolution.
+    Resolve the localization text of a key, the keys being resolved above it are in stack.
 
-    Enhanced to accurately detect circular references by tracking processed keys per recursion path.
+    Returns:
+        tuple: (resolved text, whether a circular reference was met while resolving it)
     """
-    if processed_keys is None:
-        processed_keys = []
+    if key in _resolved_cache:
+        return _resolved_cache[key], False
 
-    # Regex to find placeholders like {20201,401}
-    pattern = re.compile(r'\{(\d+),(\d+)\}')
+    if key not in name_map:
+        logger.warning(f"Missing localization for key: {key}")
+        _resolved_cache[key] = 'Unknown'
+        return 'Unknown', False
 
-    def replacer(match):
-        page_id, t_id = match.groups()
-        key = f"{page_id}_{t_id}"
+    # The localization map holds the raw texts, None for empty ones
+    raw = (name_map[key] or '').strip()
+
+    if '{' not in raw:
+        # Plain texts have no placeholders to resolve
+        resolved = PAREN_RE.sub('', raw).strip()
+        _resolved_cache[key] = resolved
+        return resolved, False
+
+    cyclic = False
 
-        # Prevent infinite recursion by checking if key is already in the current path
-        if key in processed_keys:
-            logger.warning(f"Circular reference detected for key: {key}")
+    def replacer(match):
+        nonlocal cyclic
+        nested_key = (int(match.group(1)), int(match.group(2)))
+        if nested_key in stack:
+            logger.warning(f"Circular reference detected for key: {nested_key}")
+            cyclic = True
             return match.group(0)  # Return as is
+        text, nested_cyclic = _resolve_key(nested_key, name_map, stack | {nested_key})
+        cyclic = cyclic or nested_cyclic
+        return text
+
+    resolved = PAREN_RE.sub('', PLACEHOLDER_RE.sub(replacer, raw)).strip()
+    # Texts reached through a circular reference depend on where the resolution
+    # started, so only the ones free of cycles are memoized
+    if not cyclic:
+        _resolved_cache[key] = resolved
+    return resolved, cyclic
+
+def resolve_key(key, name_map):
+    """
+    Resolve the localization text of a key, replacing nested placeholders in the format
+    {pageID,tID} and removing any text within parentheses.
 
-        processed_keys.append(key)  # Add key to the current path
+    Results are memoized in _resolved_cache, so every key is resolved only once per run.
+    """
+    return _resolve_key(key, name_map, frozenset())[0]
 
-        replacement = name_map.get(key, 'Unknown')
-        if replacement == 'Unknown':
-            logger.warning(f"Missing localization for key: {key}")
-            processed_keys.pop()  # Remove key from the current path before returning
-            return 'Unknown'
+def _parse_dataset(dataset, source, mapdefaults_file, name_map, exclude_patterns):
+    """Extract the row tuple of a dataset element, or None if the dataset is skipped."""
+    macro = dataset.get('macro')
+    if not macro:
+        return None
 
-        # Recursively resolve if replacement contains more placeholders
-        replacement = resolve_placeholders(replacement, name_map, processed_keys, max_depth - 1)
+    macro = macro.strip()  # Remove leading and trailing spaces
 
-        processed_keys.pop()  # Remove key from the current path after resolving
-        return replacement
+    # Exclude macros matching any of the exclude patterns
+    if any(pattern.match(macro) for pattern in exclude_patterns):
+        logger.info(f"Excluded macro '{macro}' from '{mapdefaults_file}' based on exclusion patterns.")
+        return None
+
+    cluster_id, sector_id, entry_type = extract_cluster_sector(macro)
 
-    # Iterate up to max_depth to resolve nested placeholders
-    current_text = text
-    for depth in range(max_depth):
-        new_text = pattern.sub(replacer, current_text)
-        if new_text == current_text:
-            break
-        logger.debug(f"Depth {depth + 1}: {current_text} -> {new_text}")
-        current_text = new_text
+    identification = dataset.find('.//identification')
+    if identification is None:
+        return None
+
+    name_attr = identification.get('name')
+    if not name_attr:
+        return None
+
+    name_attr = name_attr.strip()  # Remove leading and trailing spaces
+    name_ref = parse_name_reference(name_attr)
+    if not name_ref:
+        logger.warning(f"Invalid name reference '{name_attr}' in {mapdefaults_file}")
+        name = 'Unknown'
     else:
-        logger.warning(f"Max recursion depth reached while resolving: {text}")
+        name = resolve_key(name_ref, name_map)
 
-    # Remove any text within parentheses
-    resolved_text = re.sub(r'\s*\([^)]*\)', '', current_text).strip()
+    # Store tuple with sorting key first, then the row data in CSV column order
+    return (cluster_id, sector_id, macro, name, source, entry_type)
 
-    return resolved_text
+def _parse_mapdefaults_file(source, mapdefaults_file, name_map, exclude_patterns):
+    """
+    Parse one mapdefaults.xml file.
+
+    Returns:
+        list: Row tuples of the file, empty if the file failed to parse
+    """
+    file_rows = []
+    try:
+        # Stream the datasets, freeing each one once its row is extracted
+        for dataset in iter_elements(mapdefaults_file, 'dataset'):
+            row_data = _parse_dataset(dataset, source, mapdefaults_file, name_map, exclude_patterns)
+            if row_data is not None:
+                file_rows.append(row_data)
+    except ET.ParseError as e:
+        logger.error(f"XML parsing error in {mapdefaults_file}: {e}")
+        return []  # Skip the rows streamed from the broken file
+    except Exception as e:
+        logger.error(f"Error processing {mapdefaults_file}: {e}")
+
+    return file_rows
 
 def process_mapdefaults(mapdefaults_files, name_map, exclude_patterns, output_folder):
     """Process all mapdefaults.xml files and write to mapdefaults_output.csv sorted by cluster and sector."""
@@ -165,62 +199,22 @@ def process_mapdefaults(mapdefaults_files, name_map, exclude_patterns, output_fo
             return
 
     for source, mapdefaults_file in mapdefaults_files:
-        try:
-            tree = ET.parse(mapdefaults_file)
-            root = tree.getroot()
-
-            for dataset in root.findall('.//dataset'):
-                macro = dataset.get('macro')
-                if not macro:
-                    continue
-
-                macro = macro.strip()  # Remove leading and trailing spaces
-
-                # Exclude macros matching any of the exclude patterns
-                if any(re.match(pattern, macro) for pattern in exclude_patterns):
-                    logger.info(f"Excluded macro '{macro}' from '{mapdefaults_file}' based on exclusion patterns.")
-                    continue
-
-                cluster_id, sector_id, entry_type = extract_cluster_sector(macro)
-
-                identification = dataset.find('.//identification')
-                if identification is not None:
-                    name_attr = identification.get('name')
-                    if not name_attr:
-                        continue
-
-                    name_attr = name_attr.strip()  # Remove leading and trailing spaces
-                    name_ref = parse_name_reference(name_attr)
-                    if not name_ref:
-                        logger.warning(f"Invalid name reference '{name_attr}' in {mapdefaults_file}")
-                        name = 'Unknown'
-                    else:
-                        raw_name = name_map.get(name_ref, 'Unknown')
-                        name = resolve_placeholders(raw_name, name_map)
-
-                    # Store tuple with sorting key and row data
-                    row_data = (cluster_id, sector_id, entry_type, macro, name, source)
-                    all_rows.append(row_data)
-        except ET.ParseError as e:
-            logger.error(f"XML parsing error in {mapdefaults_file}: {e}")
-        except Exception as e:
-            logger.error(f"Error processing {mapdefaults_file}: {e}")
+        all_rows.extend(_parse_mapdefaults_file(source, mapdefaults_file, name_map, exclude_patterns))
 
     # Sort all_rows based on cluster_id and sector_id numerically
-    all_rows.sort(key=lambda x: (x[0], x[1]))  # (cluster_id, sector_id)
+    all_rows.sort(key=itemgetter(0, 1))  # (cluster_id, sector_id)
 
     # Define output CSV file path
     output_path = os.path.join(output_folder, 'mapdefaults_output.csv')
 
     # Write to CSV including 'type'
-    with open(output_path, 'w', newline='', encoding='utf-8') as csvfile:
+    with open_output_csv(output_path) as csvfile:
         writer = csv.writer(csvfile)
         # Headers including 'type'
         writer.writerow(['macro', 'name', 'source', 'type'])
 
-        for row in all_rows:
-            macro, name, source, entry_type = row[3], row[4], row[5], row[2]
-            writer.writerow([macro, name, source, entry_type])
+        # (macro, name, source, type) for every row, written in one call
+        writer.writerows(row[2:] for row in all_rows)
 
 def get_base_folder():
     """Get base folder from args or user input"""
@@ -261,6 +255,9 @@ def main():
         base_folder, exclude_patterns, output_folder = get_base_folder()
         libraries_path, t_path = validate_folder_structure(base_folder)
 
+        # Compile the exclusion patterns once for all macros
+        exclude_patterns = [re.compile(pattern) for pattern in exclude_patterns]
+
         # Find all mapdefaults.xml files
         mapdefaults_files = find_mapdefaults_files(base_folder)
 
@@ -1,9 +1,20 @@
-import xml.etree.ElementTree as ET
 import csv
 import os
 import logging
 import argparse
 import sys
+import re
+
+from x4_common import (
+    ET,
+    LXML_AVAILABLE,
+    CSV_LINE_TERMINATOR,
+    CSV_SPECIAL_CHARS,
+    iter_extension_dirs,
+    load_localization,
+    open_output_csv,
+    parse_name_reference
+)
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
@@ -12,47 +23,30 @@ logger = logging.getLogger(__name__)
 # Define valid transport types
 VALID_TRANSPORT = {'container', 'liquid', 'solid'}
 
+# Regex to find the 'module' tag in a ware's space separated tags
+_MODULE_TAG = re.compile(r'(?:^|\s)module(?:\s|$)')
+
+if LXML_AVAILABLE:
+    # Tradeable, priced and non module wares, selected by lxml before any Python checks
+    _TRADE_WARES_XPATH = ET.XPath(
+        ".//ware[not(contains(concat(' ', normalize-space(@tags), ' '), ' module '))"
+        " and (@transport='container' or @transport='liquid' or @transport='solid')"
+        " and price]"
+    )
+
 # Define default output folder
 DEFAULT_OUTPUT_FOLDER = 'output'
 
-def parse_name_reference(name_ref):
-    """Parse name reference like {20201,401} into (page_id, t_id)"""
-    if not name_ref:
-        return None
-    try:
-        name_ref = name_ref.strip('{}')
-        page_id, t_id = map(int, name_ref.split(','))
-        return f"{page_id}_{t_id}"
-    except:
-        return None
-
-def load_localization(file_path):
-    """Load localization mappings from l044 file using page/t structure"""
-    name_map = {}
-    try:
-        tree = ET.parse(file_path)
-        root = tree.getroot()
-
-        # Find all page elements
-        for page in root.findall('.//page'):
-            page_id = page.get('id')
-            if not page_id:
-                continue
-
-            # Process t elements within each page
-            for t in page.findall('.//t'):
-                t_id = t.get('id')
-                if t_id:
-                    # Create combined key: pageID_tID
-                    key = f"{page_id}_{t_id}"
-                    name_map[key] = t.text
-        return name_map
-    except Exception as e:
-        logger.error(f"Error loading localization: {e}")
-        return {}
+# CSV line of a ware: name, min, max, the seven price ranges, transport and source,
+# ended with the csv module's default line terminator
+CSV_LINE_FORMAT = '%s,%s,%s,%.0f,%.0f,%.0f,%.0f,%.0f,%.0f,%.0f,%s,%s' + CSV_LINE_TERMINATOR
 
 def calculate_price_ranges(min_price, max_price):
-    """Calculate price ranges as intervals around average using half range"""
+    """Calculate price ranges as intervals around average using half range
+
+    Returns:
+        tuple: (avg, 30% min, 30% max, 50% min, 50% max, 70% min, 70% max)
+    """
     min_price = float(min_price)
     max_price = float(max_price)
     avg_price = (min_price + max_price) / 2
@@ -65,16 +59,15 @@ def calculate_price_ranges(min_price, max_price):
             return max_price
         return price
 
-    ranges = {
-        'avg': avg_price,
-        '30_min': bound_price(avg_price - (0.30 * half_range)),
-        '30_max': bound_price(avg_price + (0.30 * half_range)),
-        '50_min': bound_price(avg_price - (0.50 * half_range)),
-        '50_max': bound_price(avg_price + (0.50 * half_range)),
-        '70_min': bound_price(avg_price - (0.70 * half_range)),
-        '70_max': bound_price(avg_price + (0.70 * half_range))
-    }
-    return ranges
+    return (
+        avg_price,
+        bound_price(avg_price - (0.30 * half_range)),
+        bound_price(avg_price + (0.30 * half_range)),
+        bound_price(avg_price - (0.50 * half_range)),
+        bound_price(avg_price + (0.50 * half_range)),
+        bound_price(avg_price - (0.70 * half_range)),
+        bound_price(avg_price + (0.70 * half_range))
+    )
 
 def get_base_folder():
     """Get base folder from args or user input"""
@@ -122,10 +115,10 @@ def find_wares_files(base_folder):
     # Search extensions
     extensions_path = os.path.join(base_folder, 'extensions')
     if os.path.exists(extensions_path):
-        for ext_dir in os.listdir(extensions_path):
-            ext_wares = os.path.join(extensions_path, ext_dir, 'libraries', 'wares.xml')
+        for ext_name, ext_path in iter_extension_dirs(extensions_path):
+            ext_wares = os.path.join(ext_path, 'libraries', 'wares.xml')
             if os.path.exists(ext_wares):
-                wares_files.append((ext_dir, ext_wares))
+                wares_files.append((ext_name, ext_wares))
 
     if not wares_files:
         raise FileNotFoundError("No wares.xml files found")
@@ -133,6 +126,62 @@ def find_wares_files(base_folder):
     logger.info(f"Found {len(wares_files)} wares.xml files")
     return wares_files
 
+def _csv_field(value):
+    """Format a text value as csv.writer does, quoting it only when needed"""
+    if value is None:
+        return ''
+    if any(char in value for char in CSV_SPECIAL_CHARS):
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
+def _parse_wares_file(source, wares_file, name_map, parser=None):
+    """
+    Parse one wares.xml file.
+
+    Args:
+        source (str): Source of the file, 'original' or the extension folder name
+        wares_file (str): Path to the wares.xml file
+        name_map (dict): Localization map
+        parser: Optional XML parser to reuse, None for a new default parser
+
+    Returns:
+        str: CSV lines of the tradeable wares with their price ranges
+    """
+    source_field = _csv_field(source)
+    lines = []
+
+    tree = ET.parse(wares_file, parser)
+    root = tree.getroot()
+
+    if LXML_AVAILABLE:
+        # Most wares are filtered out in C, the checks below only confirm the rest
+        candidates = _TRADE_WARES_XPATH(root)
+    else:
+        candidates = root.findall('.//ware')
+
+    for ware in candidates:
+        if _MODULE_TAG.search(ware.get('tags') or ''):
+            continue
+
+        transport = ware.get('transport')
+        if transport not in VALID_TRANSPORT:
+            continue
+
+        name_ref = parse_name_reference(ware.get('name'))
+        price = ware.find('price')
+
+        if price is not None and name_ref:
+            name = name_map.get(name_ref, 'Unknown')
+            min_price = price.get('min')
+            max_price = price.get('max')
+
+            if min_price and max_price:
+                prices = calculate_price_ranges(min_price, max_price)
+                lines.append(CSV_LINE_FORMAT % (_csv_field(name), _csv_field(min_price), _csv_field(max_price),
+                                                *prices, transport, source_field))
+
+    return ''.join(lines)
+
 def process_all_wares(wares_files, name_map, output_folder):
     # Ensure the output folder exists
     if not os.path.exists(output_folder):
@@ -146,7 +195,7 @@ def process_all_wares(wares_files, name_map, output_folder):
     output_path = os.path.join(output_folder, 'trade_wares_with_prices.csv')
 
     """Process all wares.xml files keeping source information"""
-    with open(output_path, 'w', newline='', encoding='utf-8') as csvfile:
+    with open_output_csv(output_path) as csvfile:
         writer = csv.writer(csvfile)
         writer.writerow(['name', 'min', 'max', 'avg',
                         '30% min', '30% max',
@@ -154,40 +203,10 @@ def process_all_wares(wares_files, name_map, output_folder):
                         '70% min', '70% max',
                         'transport', 'source'])
 
+        # lxml parsers can parse any number of documents, the stdlib one only a single one
+        parser = ET.XMLParser() if LXML_AVAILABLE else None
         for source, wares_file in wares_files:
-            tree = ET.parse(wares_file)
-            root = tree.getroot()
-
-            for ware in root.findall('.//ware'):
-                if 'module' in ware.get('tags', '').split():
-                    continue
-
-                transport = ware.get('transport')
-                if transport not in VALID_TRANSPORT:
-                    continue
-
-                name_ref = parse_name_reference(ware.get('name'))
-                price = ware.find('price')
-
-                if price is not None and name_ref:
-                    name = name_map.get(name_ref, 'Unknown')
-                    min_price = price.get('min')
-                    max_price = price.get('max')
-
-                    if min_price and max_price:
-                        ranges = calculate_price_ranges(min_price, max_price)
-                        writer.writerow([
-                            name, min_price, max_price,
-                            f"{ranges['avg']:.0f}",
-                            f"{ranges['30_min']:.0f}",
-                            f"{ranges['30_max']:.0f}",
-                            f"{ranges['50_min']:.0f}",
-                            f"{ranges['50_max']:.0f}",
-                            f"{ranges['70_min']:.0f}",
-                            f"{ranges['70_max']:.0f}",
-                            transport,
-                            source
-                        ])
+            csvfile.write(_parse_wares_file(source, wares_file, name_map, parser))
 
 def main():
     try:
@@ -0,0 +1,197 @@
+import io
+import logging
+import os
+import re
+
+try:
+    import lxml.etree as ET
+    LXML_AVAILABLE = True
+except ImportError:
+    import xml.etree.ElementTree as ET
+    LXML_AVAILABLE = False
+    from xml.parsers import expat
+
+logger = logging.getLogger(__name__)
+
+# Write buffer size for output CSV files (1 MiB)
+CSV_BUFFER_SIZE = 1 << 20
+
+# Characters that make csv.writer quote a value
+CSV_SPECIAL_CHARS = (',', '"', '\r', '\n')
+# Line terminator used by the csv module by default
+CSV_LINE_TERMINATOR = '\r\n'
+
+# Maximum number of XML files parsed concurrently
+MAX_PARSE_WORKERS = 8
+
+# Regex to find placeholders like {20201,401}
+PLACEHOLDER_RE = re.compile(r'\{(\d+),(\d+)\}')
+# Regex to find text within parentheses
+PAREN_RE = re.compile(r'\s*\([^)]*\)')
+
+def parse_name_reference(name_ref):
+    """Parse name reference like {20201,401} into (page_id, t_id)"""
+    if not name_ref:
+        return None
+    try:
+        name_ref = name_ref.strip('{}')
+        page_id, t_id = map(int, name_ref.split(','))
+        return (page_id, t_id)
+    except:
+        return None
+
+def _parse_id(value):
+    """Parse a page or t id attribute into an int, or None if it is missing or not a number"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def _load_localization_expat(file_path):
+    """
+    Load localization mappings with a bare Expat parser, used when lxml is not available.
+
+    No elements are built, and with text buffering Expat reports the text of a <t>
+    element in one callback instead of one per line or entity.
+
+    Returns:
+        dict: (pageID, tID) key to the text before the first child of the <t> element
+    """
+    name_map = {}
+    page_id = None
+    t_id = None
+    t_text = None
+    collecting = False
+
+    def start_element(tag, attrs):
+        nonlocal page_id, t_id, t_text, collecting
+        if tag == 'page':
+            page_id = _parse_id(attrs.get('id'))
+        elif tag == 't':
+            t_id = _parse_id(attrs.get('id'))
+            t_text = None
+            collecting = True
+        else:
+            # Like elem.text, only the text before the first child element counts
+            collecting = False
+
+    def end_element(tag):
+        nonlocal page_id, t_id, collecting
+        if tag == 'page':
+            page_id = None
+        elif tag == 't':
+            collecting = False
+            if page_id is not None and t_id is not None:
+                # Key on the (pageID, tID) pair
+                name_map[(page_id, t_id)] = t_text
+            t_id = None
+
+    def character_data(data):
+        nonlocal t_text
+        if collecting:
+            t_text = data if t_text is None else t_text + data
+
+    parser = expat.ParserCreate()
+    parser.buffer_text = True
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.CharacterDataHandler = character_data
+    with open(file_path, 'rb') as f:
+        parser.ParseFile(f)
+    return name_map
+
+def load_localization(file_path):
+    """Load localization mappings from l044 file using page/t structure.
+
+    The file is streamed with lxml's iterparse, so only the current page is kept in memory.
+    Without lxml a bare Expat parser with text buffering is used instead.
+
+    Returns:
+        dict: (pageID, tID) key to the raw text, None for an empty <t> element
+    """
+    name_map = {}
+    try:
+        if not LXML_AVAILABLE:
+            name_map = _load_localization_expat(file_path)
+            logger.info(f"Loaded {len(name_map)} localization entries from {file_path}")
+            return name_map
+        page_id = None
+        # Only page and t elements are reported, lxml skips everything else in C
+        for event, elem in ET.iterparse(file_path, events=('start', 'end'), tag=('page', 't')):
+            if elem.tag == 'page':
+                # Track the page id on start, forget it once the page is closed
+                if event == 'start':
+                    page_id = _parse_id(elem.get('id'))
+                else:
+                    page_id = None
+                    elem.clear()
+                continue
+
+            if event != 'end' or elem.tag != 't':
+                continue
+
+            t_id = _parse_id(elem.get('id'))
+            if page_id is not None and t_id is not None:
+                # Key on the (pageID, tID) pair
+                key = (page_id, t_id)
+                name_map[key] = elem.text
+
+            # Free the processed element and the already handled siblings
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+
+        logger.info(f"Loaded {len(name_map)} localization entries from {file_path}")
+        return name_map
+    except Exception as e:
+        logger.error(f"Error loading localization: {e}")
+        return {}
+
+def iter_extension_dirs(extensions_path):
+    """Yield (name, path) of every extension folder in extensions_path"""
+    # scandir entries already know their type, so plain files are skipped without a stat call
+    with os.scandir(extensions_path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                yield entry.name, entry.path
+
+def iter_elements(file_path, tag, top_level=False):
+    """
+    Stream the elements with the given tag from an XML file.
+
+    By default the elements are matched at any depth, like './/tag'; with top_level
+    only the direct children of the root element are, like root.findall(tag).
+
+    Each element is freed once the caller asks for the next one: lxml also drops the
+    already handled siblings, while the stdlib parser has no parent links, so the
+    handled elements are dropped from the root element instead.
+    """
+    if LXML_AVAILABLE:
+        for _, elem in ET.iterparse(file_path, events=('end',), tag=tag):
+            parent = elem.getparent()
+            if top_level and (parent is None or parent.getparent() is not None):
+                continue
+            yield elem
+            elem.clear()
+            while elem.getprevious() is not None:
+                del parent[0]
+    else:
+        root = None
+        depth = 0
+        for event, elem in ET.iterparse(file_path, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = elem  # The first 'start' event is the root element
+                depth += 1
+                continue
+            depth -= 1
+            if elem.tag != tag or (top_level and depth != 1):
+                continue
+            yield elem
+            root.clear()
+
+def open_output_csv(output_path):
+    """Open output CSV file for text writing through a large write buffer"""
+    raw = open(output_path, 'wb', buffering=0)
+    buffered = io.BufferedWriter(raw, buffer_size=CSV_BUFFER_SIZE)
+    return io.TextIOWrapper(buffered, encoding='utf-8', newline='', write_through=False)